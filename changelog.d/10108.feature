@@ -0,0 +1 @@
+Support the `synchronous_commit` database option on SQLite, which switches the database to WAL mode with `synchronous=NORMAL` for faster writes.
@@ -40,6 +40,16 @@ DEFAULT_CONFIG = """\
 #   * for postgres: https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-PARAMKEYWORDS
 #   * for the connection pool: https://twistedmatrix.com/documents/current/api/twisted.enterprise.adbapi.ConnectionPool.html#__init__
 #
+# 'synchronous_commit' can be set to false to trade durability for faster
+# writes. Commits then no longer wait for the data to be flushed to disk, so
+# the most recent transactions may be lost on a power failure or OS crash,
+# although the database itself stays consistent. Defaults to true.
+#   * for postgres, this turns off synchronous_commit for Synapse's connections.
+#   * for sqlite, this switches the database to WAL mode with synchronous=NORMAL.
+#     WAL mode is a property of the database file and stays enabled if the
+#     option is later turned back on (which restores full durability). It
+#     requires all access to the database to be from the same host.
+#
 #
 # Example SQLite configuration:
 #
@@ -120,6 +120,10 @@ CONDITIONAL_REQUIREMENTS = {
     "redis": ["txredisapi>=1.4.7", "hiredis"],
     # Required to use experimental `caches.track_memory_usage` config option.
     "cache_memory": ["pympler"],
+    # orjson is not a *strict* dependency, but it makes deserialising
+    # to-device messages much faster. (if it is not installed, we fall back to
+    # the stdlib json module.)
+    "orjson": ["orjson>=3.0"],
 }
 
 ALL_OPTIONAL_REQUIREMENTS = set()  # type: Set[str]
@@ -13,6 +13,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import logging
 import time
 from sys import intern
@@ -80,6 +81,16 @@ UNIQUE_INDEX_BACKGROUND_UPDATES = {
 }
 
 
+@functools.lru_cache(maxsize=1024)
+def _make_sql_one_line(sql: str) -> str:
+    """Strip newlines out of SQL so that the loggers in the DB are on one line.
+
+    This is cached as most queries are module or function level constants that
+    get executed over and over again.
+    """
+    return " ".join(line.strip() for line in sql.splitlines() if line.strip())
+
+
 def make_pool(
     reactor, db_config: DatabaseConnectionConfig, engine: BaseDatabaseEngine
 ) -> adbapi.ConnectionPool:
@@ -292,12 +303,8 @@ class LoggingTransaction:
     def executemany(self, sql: str, *args: Any) -> None:
         self._do_execute(self.txn.executemany, sql, *args)
 
-    def _make_sql_one_line(self, sql: str) -> str:
-        "Strip newlines out of SQL so that the loggers in the DB are on one line"
-        return " ".join(line.strip() for line in sql.splitlines() if line.strip())
-
     def _do_execute(self, func: Callable[..., R], sql: str, *args: Any) -> R:
-        sql = self._make_sql_one_line(sql)
+        sql = _make_sql_one_line(sql)
 
         # TODO(paul): Maybe use 'info' and 'debug' for values?
         sql_logger.debug("[SQL] {%s} %s", self.name, sql)
@@ -12,22 +12,160 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import logging
-from typing import List, Optional, Tuple
+import re
+from typing import Any, Collection, Dict, List, Optional, Tuple, Union
 
 from synapse.logging import issue9533_logger
 from synapse.logging.opentracing import log_kv, set_tag, trace
 from synapse.replication.tcp.streams import ToDeviceStream
 from synapse.storage._base import SQLBaseStore, db_to_json
-from synapse.storage.database import DatabasePool
+from synapse.storage.database import DatabasePool, LoggingTransaction
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.util.id_generators import MultiWriterIdGenerator, StreamIdGenerator
+from synapse.types import JsonDict
 from synapse.util import json_encoder
+from synapse.util.batching_queue import BatchingQueue
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.stream_change_cache import StreamChangeCache
+from synapse.util.iterutils import batch_iter
 
 logger = logging.getLogger(__name__)
 
+# Messages are always encoded with the standard encoder: orjson rejects some
+# input that it accepts (lone surrogates, integers wider than 64 bits) and
+# silently encodes NaNs as `null`.
+_encode_json = json_encoder.encode
+
+try:
+    # orjson is not a *strict* dependency, but it is several times faster than
+    # the stdlib json module at deserialising the small dicts that make up
+    # to-device messages. If it is not installed we fall back to `db_to_json`.
+    import orjson
+
+    # orjson turns integers that don't fit in 64 bits into floats, so leave
+    # anything that might contain one to the standard decoder.
+    _LONG_DIGIT_RUN_RE = re.compile(r"\d{19}")
+
+    def _decode_json(db_content: Union[memoryview, bytes, bytearray, str]) -> Any:
+        if isinstance(db_content, str) and not _LONG_DIGIT_RUN_RE.search(db_content):
+            try:
+                return orjson.loads(db_content)
+            except orjson.JSONDecodeError:
+                # e.g. an escaped lone surrogate, which orjson rejects.
+                pass
+
+        return db_to_json(db_content)
+
+
+except ImportError:
+    _decode_json = db_to_json  # type: ignore
+
+
+# The statements used to queue up to-device messages. These are built once here,
+# rather than by `simple_insert_many_txn` on every call, as they're on the hot
+# path of sending to-device messages.
+#
+# The inserts into `device_inbox` check that the recipient devices exist as
+# part of the INSERT, so that we don't need a separate round trip to fetch the
+# local devices first.
+#
+# The `%s` in the statements below gets replaced with a `(?, ...)` group per
+# row, so that a batch of rows can be inserted with a single statement (see
+# `_multi_values_insert_txn`).
+_INSERT_DEVICE_INBOX_SQL = """
+    WITH to_insert (user_id, device_id, message_json) AS (VALUES %s)
+    INSERT INTO device_inbox
+        (user_id, device_id, stream_id, message_json, instance_name)
+    SELECT user_id, device_id, ?, message_json, ?
+    FROM to_insert
+    INNER JOIN devices USING (user_id, device_id)
+"""
+
+# As above, but for messages to be sent to all of a user's devices.
+_INSERT_DEVICE_INBOX_ALL_DEVICES_SQL = """
+    WITH to_insert (user_id, message_json) AS (VALUES %s)
+    INSERT INTO device_inbox
+        (user_id, device_id, stream_id, message_json, instance_name)
+    SELECT user_id, device_id, ?, message_json, ?
+    FROM to_insert
+    INNER JOIN devices USING (user_id)
+"""
+
+_INSERT_DEVICE_FEDERATION_OUTBOX_SQL = """
+    INSERT INTO device_federation_outbox
+        (destination, stream_id, queued_ts, messages_json, instance_name)
+    VALUES %s
+"""
+
+# Records that we've received a to-device EDU from a remote server, unless we
+# have already. `device_federation_inbox` has no unique constraint on
+# (origin, message_id) that `ON CONFLICT` could use, so test for an existing
+# row in the same statement instead.
+_INSERT_DEVICE_FEDERATION_INBOX_SQL = """
+    INSERT INTO device_federation_inbox (origin, message_id, received_ts)
+    SELECT ?, ?, ?
+    WHERE NOT EXISTS (
+        SELECT 1 FROM device_federation_inbox WHERE origin = ? AND message_id = ?
+    )
+"""
+
+# The maximum number of rows to insert with a single statement. This keeps us
+# well under SQLite's default limit of 999 bound parameters.
+_MULTI_VALUES_BATCH_SIZE = 64
+
+
+@functools.lru_cache(maxsize=256)
+def _make_multi_values_sql(sql_template: str, num_columns: int, num_rows: int) -> str:
+    """Fills in the `%s` in the given SQL with `num_rows` groups of
+    `num_columns` placeholders.
+
+    This is cached as the same few statements get built over and over again.
+    """
+    group = "(%s)" % (",".join("?" * num_columns),)
+    return sql_template % (",".join(group for _ in range(num_rows)),)
+
+
+def _multi_values_insert_txn(
+    txn: LoggingTransaction,
+    sql_template: str,
+    rows: Collection[Tuple[Any, ...]],
+    extra_args: Tuple[Any, ...] = (),
+) -> None:
+    """Inserts the given rows in batches, with a multi-row `VALUES` list per
+    statement rather than a statement per row.
+
+    Args:
+        txn: The transaction to use.
+        sql_template: The SQL to run, with a `%s` where the `VALUES` list goes.
+        rows: The rows to insert. Each row must have the same number of columns.
+        extra_args: Any arguments for placeholders that come after the `VALUES`
+            list in the SQL.
+    """
+    for batch in batch_iter(rows, _MULTI_VALUES_BATCH_SIZE):
+        sql = _make_multi_values_sql(sql_template, len(batch[0]), len(batch))
+        args = [arg for row in batch for arg in row]
+        args.extend(extra_args)
+
+        txn.execute(sql, args)
+
+
+def _encode_messages_by_user_then_device(
+    messages_by_user_then_device: Dict[str, Dict[str, JsonDict]]
+) -> Dict[str, Dict[str, str]]:
+    """Encodes each of the messages in a dictionary of user_id to device_id to
+    message.
+    """
+    return {
+        user_id: {
+            device_id: _encode_json(message)
+            for device_id, message in messages_by_device.items()
+        }
+        for user_id, messages_by_device in messages_by_user_then_device.items()
+    }
+
 
 class DeviceInboxWorkerStore(SQLBaseStore):
     def __init__(self, database: DatabasePool, db_conn, hs):
@@ -44,6 +182,15 @@ class DeviceInboxWorkerStore(SQLBaseStore):
             expiry_ms=30 * 60 * 1000,
         )
 
+        # Map of (user_id, device_id) to a pair of stream IDs (from, to) such
+        # that the device is known to have no messages in the range (from, to].
+        # Combined with `_device_inbox_stream_cache` this lets us skip querying
+        # for a device's messages when only the user's other devices have had
+        # messages since.
+        self._device_inbox_last_pos_cache = LruCache(
+            cache_name="device_inbox_last_pos", max_size=10000
+        )  # type: LruCache[Tuple[str, Optional[str]], Tuple[int, int]]
+
         if isinstance(database.engine, PostgresEngine):
             self._can_write_to_device = (
                 self._instance_name in hs.config.worker.writers.to_device
@@ -95,6 +242,14 @@ class DeviceInboxWorkerStore(SQLBaseStore):
             prefilled_cache=device_outbox_prefill,
         )
 
+        # Concurrent sends of to-device messages by local users get batched up
+        # and stored in a single transaction.
+        self._add_messages_to_device_inbox_queue = BatchingQueue(
+            "add_messages_to_device_inbox",
+            self._clock,
+            self._add_messages_to_device_inbox_batch,
+        )  # type: BatchingQueue[Tuple[Dict[str, Dict[str, str]], Dict[str, str]], int]
+
     def process_replication_rows(self, stream_name, instance_name, token, rows):
         if stream_name == ToDeviceStream.NAME:
             self._device_inbox_id_gen.advance(instance_name, token)
@@ -138,6 +293,16 @@ class DeviceInboxWorkerStore(SQLBaseStore):
         if not has_changed:
             return ([], current_stream_id)
 
+        no_messages_range = self._device_inbox_last_pos_cache.get((user_id, device_id))
+        if no_messages_range is not None:
+            no_messages_from, no_messages_to = no_messages_range
+            if no_messages_from <= last_stream_id and (
+                not self._device_inbox_stream_cache.has_entity_changed(
+                    user_id, no_messages_to
+                )
+            ):
+                return ([], current_stream_id)
+
         def get_new_messages_for_device_txn(txn):
             sql = (
                 "SELECT stream_id, message_json FROM device_inbox"
@@ -149,18 +314,28 @@ class DeviceInboxWorkerStore(SQLBaseStore):
             txn.execute(
                 sql, (user_id, device_id, last_stream_id, current_stream_id, limit)
             )
-            messages = []
-            for row in txn:
-                stream_pos = row[0]
-                messages.append(db_to_json(row[1]))
-            if len(messages) < limit:
-                stream_pos = current_stream_id
-            return messages, stream_pos
+            rows = txn.fetchall()
 
-        return await self.db_pool.runInteraction(
+            if len(rows) == limit:
+                return rows, rows[-1][0]
+
+            # There are no more messages for the device up to the current
+            # position, so remember that for next time.
+            txn.call_after(
+                self._device_inbox_last_pos_cache.set,
+                (user_id, device_id),
+                (rows[-1][0] if rows else last_stream_id, current_stream_id),
+            )
+            return rows, current_stream_id
+
+        rows, stream_pos = await self.db_pool.runInteraction(
             "get_new_messages_for_device", get_new_messages_for_device_txn
         )
 
+        # We decode the messages here rather than in the transaction so that we
+        # don't hold on to the database connection while doing so.
+        return [_decode_json(message_json) for _, message_json in rows], stream_pos
+
     @trace
     async def delete_messages_for_device(
         self, user_id: str, device_id: Optional[str], up_to_stream_id: int
@@ -258,20 +433,22 @@ class DeviceInboxWorkerStore(SQLBaseStore):
                 " LIMIT ?"
             )
             txn.execute(sql, (destination, last_stream_id, current_stream_id, limit))
-            messages = []
-            for row in txn:
-                stream_pos = row[0]
-                messages.append(db_to_json(row[1]))
-            if len(messages) < limit:
-                log_kv({"message": "Set stream position to current position"})
-                stream_pos = current_stream_id
-            return messages, stream_pos
+            rows = txn.fetchall()
 
-        return await self.db_pool.runInteraction(
+            if len(rows) == limit:
+                return rows, rows[-1][0]
+
+            log_kv({"message": "Set stream position to current position"})
+            return rows, current_stream_id
+
+        rows, stream_pos = await self.db_pool.runInteraction(
             "get_new_device_msgs_for_remote",
             get_new_messages_for_remote_destination_txn,
         )
 
+        # As above, decode the messages outside of the transaction.
+        return [_decode_json(messages_json) for _, messages_json in rows], stream_pos
+
     @trace
     async def delete_device_msgs_for_remote(
         self, destination: str, up_to_stream_id: int
@@ -329,25 +506,19 @@ class DeviceInboxWorkerStore(SQLBaseStore):
             # we return.
             upper_pos = min(current_id, last_id + limit)
             sql = (
-                "SELECT max(stream_id), user_id"
+                "SELECT max(stream_id) AS stream_id, user_id AS entity"
                 " FROM device_inbox"
                 " WHERE ? < stream_id AND stream_id <= ?"
                 " GROUP BY user_id"
-            )
-            txn.execute(sql, (last_id, upper_pos))
-            updates = [(row[0], row[1:]) for row in txn]
-
-            sql = (
-                "SELECT max(stream_id), destination"
+                " UNION ALL"
+                " SELECT max(stream_id) AS stream_id, destination AS entity"
                 " FROM device_federation_outbox"
                 " WHERE ? < stream_id AND stream_id <= ?"
                 " GROUP BY destination"
+                " ORDER BY stream_id ASC, entity ASC"
             )
-            txn.execute(sql, (last_id, upper_pos))
-            updates.extend((row[0], row[1:]) for row in txn)
-
-            # Order by ascending stream ordering
-            updates.sort()
+            txn.execute(sql, (last_id, upper_pos, last_id, upper_pos))
+            updates = [(row[0], row[1:]) for row in txn]
 
             limited = False
             upto_token = current_id
@@ -381,47 +552,88 @@ class DeviceInboxWorkerStore(SQLBaseStore):
 
         assert self._can_write_to_device
 
-        def add_messages_txn(txn, now_ms, stream_id):
-            # Add the local messages directly to the local inbox.
-            self._add_messages_to_local_device_inbox_txn(
-                txn, stream_id, local_messages_by_user_then_device
-            )
+        if (
+            not local_messages_by_user_then_device
+            and not remote_messages_by_destination
+        ):
+            # There's nothing to store, so don't bother allocating a stream ID.
+            return self._device_inbox_id_gen.get_current_token()
+
+        # Encode the messages up front, so that we don't do it while holding
+        # open a transaction (or a stream ID).
+        local_messages_json_by_user_then_device = _encode_messages_by_user_then_device(
+            local_messages_by_user_then_device
+        )
+        edu_json_by_destination = {
+            destination: _encode_json(edu)
+            for destination, edu in remote_messages_by_destination.items()
+        }
 
-            # Add the remote messages to the federation outbox.
-            # We'll send them to a remote server when we next send a
-            # federation transaction to that destination.
-            self.db_pool.simple_insert_many_txn(
-                txn,
-                table="device_federation_outbox",
-                values=[
-                    {
-                        "destination": destination,
-                        "stream_id": stream_id,
-                        "queued_ts": now_ms,
-                        "messages_json": json_encoder.encode(edu),
-                        "instance_name": self._instance_name,
-                    }
-                    for destination, edu in remote_messages_by_destination.items()
-                ],
-            )
+        return await self._add_messages_to_device_inbox_queue.add_to_queue(
+            (local_messages_json_by_user_then_device, edu_json_by_destination)
+        )
+
+    async def _add_messages_to_device_inbox_batch(
+        self, batch: List[Tuple[Dict[str, Dict[str, str]], Dict[str, str]]]
+    ) -> int:
+        """Stores a batch of to-device messages sent by local users, in a
+        single transaction.
+
+        Args:
+            batch: A list of the encoded local messages, as a dict of user_id to
+                device_id to message, and encoded remote EDUs, as a dict of
+                destination to EDU, for each call to `add_messages_to_device_inbox`.
+
+        Returns:
+            The new stream_id.
+        """
+
+        def add_messages_txn(txn, now_ms, stream_ids):
+            outbox_rows = []  # type: List[Tuple[str, int, int, str, str]]
+            for stream_id, (local_messages_json, edu_json_by_destination) in zip(
+                stream_ids, batch
+            ):
+                # Add the local messages directly to the local inbox.
+                self._add_messages_to_local_device_inbox_txn(
+                    txn, stream_id, local_messages_json
+                )
+
+                if not edu_json_by_destination:
+                    continue
+
+                outbox_rows.extend(
+                    (destination, stream_id, now_ms, edu_json, self._instance_name)
+                    for destination, edu_json in edu_json_by_destination.items()
+                )
 
-            if remote_messages_by_destination:
                 issue9533_logger.debug(
                     "Queued outgoing to-device messages with stream_id %i for %s",
                     stream_id,
-                    list(remote_messages_by_destination.keys()),
+                    list(edu_json_by_destination),
                 )
 
-        async with self._device_inbox_id_gen.get_next() as stream_id:
+            # Add the remote messages to the federation outbox.
+            # We'll send them to a remote server when we next send a
+            # federation transaction to that destination.
+            _multi_values_insert_txn(
+                txn, _INSERT_DEVICE_FEDERATION_OUTBOX_SQL, outbox_rows
+            )
+
+        # Each call gets its own stream ID, so that the messages are still
+        # ordered (and acknowledged by remote servers) per call.
+        async with self._device_inbox_id_gen.get_next_mult(len(batch)) as stream_ids:
             now_ms = self.clock.time_msec()
             await self.db_pool.runInteraction(
-                "add_messages_to_device_inbox", add_messages_txn, now_ms, stream_id
+                "add_messages_to_device_inbox", add_messages_txn, now_ms, stream_ids
             )
-            for user_id in local_messages_by_user_then_device.keys():
-                self._device_inbox_stream_cache.entity_has_changed(user_id, stream_id)
-            for destination in remote_messages_by_destination.keys():
-                self._device_federation_outbox_stream_cache.entity_has_changed(
-                    destination, stream_id
+            for stream_id, (local_messages_json, edu_json_by_destination) in zip(
+                stream_ids, batch
+            ):
+                self._device_inbox_stream_cache.entities_have_changed(
+                    local_messages_json, stream_id
+                )
+                self._device_federation_outbox_stream_cache.entities_have_changed(
+                    edu_json_by_destination, stream_id
                 )
 
         return self._device_inbox_id_gen.get_current_token()
@@ -431,36 +643,27 @@ class DeviceInboxWorkerStore(SQLBaseStore):
     ) -> int:
         assert self._can_write_to_device
 
-        def add_messages_txn(txn, now_ms, stream_id):
-            # Check if we've already inserted a matching message_id for that
-            # origin. This can happen if the origin doesn't receive our
-            # acknowledgement from the first time we received the message.
-            already_inserted = self.db_pool.simple_select_one_txn(
-                txn,
-                table="device_federation_inbox",
-                keyvalues={"origin": origin, "message_id": message_id},
-                retcols=("message_id",),
-                allow_none=True,
-            )
-            if already_inserted is not None:
-                return
+        local_messages_json_by_user_then_device = _encode_messages_by_user_then_device(
+            local_messages_by_user_then_device
+        )
 
+        def add_messages_txn(txn, now_ms, stream_id):
             # Add an entry for this message_id so that we know we've processed
-            # it.
-            self.db_pool.simple_insert_txn(
-                txn,
-                table="device_federation_inbox",
-                values={
-                    "origin": origin,
-                    "message_id": message_id,
-                    "received_ts": now_ms,
-                },
+            # it. If nothing was inserted then we've already seen a matching
+            # message_id for that origin. This can happen if the origin doesn't
+            # receive our acknowledgement from the first time we received the
+            # message.
+            txn.execute(
+                _INSERT_DEVICE_FEDERATION_INBOX_SQL,
+                (origin, message_id, now_ms, origin, message_id),
             )
+            if txn.rowcount == 0:
+                return
 
             # Add the messages to the appropriate local device inboxes so that
             # they'll be sent to the devices when they next sync.
             self._add_messages_to_local_device_inbox_txn(
-                txn, stream_id, local_messages_by_user_then_device
+                txn, stream_id, local_messages_json_by_user_then_device
             )
 
         async with self._device_inbox_id_gen.get_next() as stream_id:
@@ -471,86 +674,75 @@ class DeviceInboxWorkerStore(SQLBaseStore):
                 now_ms,
                 stream_id,
             )
-            for user_id in local_messages_by_user_then_device.keys():
-                self._device_inbox_stream_cache.entity_has_changed(user_id, stream_id)
+            self._device_inbox_stream_cache.entities_have_changed(
+                local_messages_by_user_then_device, stream_id
+            )
 
         return stream_id
 
     def _add_messages_to_local_device_inbox_txn(
-        self, txn, stream_id, messages_by_user_then_device
-    ):
-        assert self._can_write_to_device
+        self,
+        txn: LoggingTransaction,
+        stream_id: int,
+        messages_json_by_user_then_device: Dict[str, Dict[str, str]],
+    ) -> None:
+        """Adds the given messages to the inboxes of the local devices they
+        are addressed to, dropping those addressed to unknown devices.
 
-        local_by_user_then_device = {}
-        for user_id, messages_by_device in messages_by_user_then_device.items():
-            messages_json_for_user = {}
-            devices = list(messages_by_device.keys())
-            if len(devices) == 1 and devices[0] == "*":
-                # Handle wildcard device_ids.
-                devices = self.db_pool.simple_select_onecol_txn(
-                    txn,
-                    table="devices",
-                    keyvalues={"user_id": user_id},
-                    retcol="device_id",
-                )
+        Args:
+            txn: The transaction to use.
+            stream_id: The stream ID to store the messages at.
+            messages_json_by_user_then_device: Dictionary of user_id to
+                device_id to the encoded message. A device_id of "*" sends the
+                message to all of the user's devices.
+        """
+        assert self._can_write_to_device
 
-                message_json = json_encoder.encode(messages_by_device["*"])
-                for device_id in devices:
-                    # Add the message for all devices for this user on this
-                    # server.
-                    messages_json_for_user[device_id] = message_json
+        # The (user_id, message_json) of each message to send to all of the
+        # user's devices, and the (user_id, device_id, message_json) of each
+        # message to send to a specific device.
+        wildcard_messages = []  # type: List[Tuple[str, str]]
+        device_messages = []  # type: List[Tuple[str, str, str]]
+        for user_id, messages_by_device in messages_json_by_user_then_device.items():
+            if len(messages_by_device) == 1 and "*" in messages_by_device:
+                wildcard_messages.append((user_id, messages_by_device["*"]))
             else:
-                if not devices:
-                    continue
-
-                rows = self.db_pool.simple_select_many_txn(
-                    txn,
-                    table="devices",
-                    keyvalues={"user_id": user_id},
-                    column="device_id",
-                    iterable=devices,
-                    retcols=("device_id",),
+                device_messages.extend(
+                    (user_id, device_id, message_json)
+                    for device_id, message_json in messages_by_device.items()
                 )
 
-                for row in rows:
-                    # Only insert into the local inbox if the device exists on
-                    # this server
-                    device_id = row["device_id"]
-                    message_json = json_encoder.encode(messages_by_device[device_id])
-                    messages_json_for_user[device_id] = message_json
-
-            if messages_json_for_user:
-                local_by_user_then_device[user_id] = messages_json_for_user
-
-        if not local_by_user_then_device:
-            return
-
-        self.db_pool.simple_insert_many_txn(
+        _multi_values_insert_txn(
             txn,
-            table="device_inbox",
-            values=[
-                {
-                    "user_id": user_id,
-                    "device_id": device_id,
-                    "stream_id": stream_id,
-                    "message_json": message_json,
-                    "instance_name": self._instance_name,
-                }
-                for user_id, messages_by_device in local_by_user_then_device.items()
-                for device_id, message_json in messages_by_device.items()
-            ],
+            _INSERT_DEVICE_INBOX_ALL_DEVICES_SQL,
+            wildcard_messages,
+            (stream_id, self._instance_name),
         )
-
-        issue9533_logger.debug(
-            "Stored to-device messages with stream_id %i for %s",
-            stream_id,
-            [
-                (user_id, device_id)
-                for (user_id, messages_by_device) in local_by_user_then_device.items()
-                for device_id in messages_by_device.keys()
-            ],
+        _multi_values_insert_txn(
+            txn,
+            _INSERT_DEVICE_INBOX_SQL,
+            device_messages,
+            (stream_id, self._instance_name),
         )
 
+        # Only messages to devices that exist on this server get inserted, so
+        # to log which devices we actually stored messages for we need to read
+        # them back. (We can't rely on `txn.rowcount` for that, as SQLite
+        # reports -1 for statements starting with `WITH`.) This is expensive
+        # for large fanouts, so only do it if it's going to be logged.
+        if issue9533_logger.isEnabledFor(logging.DEBUG):
+            rows = self.db_pool.simple_select_list_txn(
+                txn,
+                table="device_inbox",
+                keyvalues={"stream_id": stream_id},
+                retcols=("user_id", "device_id"),
+            )
+            issue9533_logger.debug(
+                "Stored to-device messages with stream_id %i for %s",
+                stream_id,
+                [(row["user_id"], row["device_id"]) for row in rows],
+            )
+
 
 class DeviceInboxBackgroundUpdateStore(SQLBaseStore):
     DEVICE_INBOX_STREAM_ID = "device_inbox_stream_drop"
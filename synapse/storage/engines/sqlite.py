@@ -33,6 +33,14 @@ class Sqlite3Engine(BaseDatabaseEngine["sqlite3.Connection"]):
             ":memory:",
         )
 
+        # As with Postgres, setting `synchronous_commit` to false trades
+        # durability for write throughput: the database is switched to WAL mode
+        # with `synchronous=NORMAL`, so commits no longer wait for an fsync.
+        # The database stays consistent, but the most recent transactions may
+        # be lost after a power failure or OS crash. WAL mode requires that all
+        # connections to the database are on the same host.
+        self.synchronous_commit = database_config.get("synchronous_commit", True)
+
         if platform.python_implementation() == "PyPy":
             # pypy's sqlite3 module doesn't handle bytearrays, convert them
             # back to bytes.
@@ -89,6 +97,12 @@ class Sqlite3Engine(BaseDatabaseEngine["sqlite3.Connection"]):
 
         db_conn.create_function("rank", 1, _rank)
         db_conn.execute("PRAGMA foreign_keys = ON;")
+
+        # In memory databases don't support WAL mode, and never hit the disk
+        # anyway.
+        if not self.synchronous_commit and not self._is_in_memory:
+            db_conn.execute("PRAGMA journal_mode = WAL;")
+            db_conn.execute("PRAGMA synchronous = NORMAL;")
         db_conn.commit()
 
     def is_deadlock(self, error):
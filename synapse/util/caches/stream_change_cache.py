@@ -14,7 +14,17 @@
 
 import logging
 import math
-from typing import Collection, Dict, FrozenSet, List, Mapping, Optional, Set, Union
+from typing import (
+    Collection,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Union,
+)
 
 from sortedcontainers import SortedDict
 
@@ -195,6 +205,41 @@ class StreamChangeCache:
             for entity in r:
                 del self._entity_to_key[entity]
 
+    def entities_have_changed(
+        self, entities: Iterable[EntityType], stream_pos: int
+    ) -> None:
+        """Informs the cache that the given entities have all been changed at the
+        given position.
+
+        This is equivalent to calling `entity_has_changed` for each entity, but
+        only looks up the entry for the position and checks the size of the
+        cache once.
+        """
+        assert type(stream_pos) is int
+
+        if stream_pos <= self._earliest_known_stream_pos:
+            return
+
+        e1 = self._cache.get(stream_pos)
+        for entity in entities:
+            old_pos = self._entity_to_key.get(entity, None)
+            if old_pos is not None:
+                if old_pos >= stream_pos:
+                    # nothing to do
+                    continue
+                e = self._cache[old_pos]
+                e.remove(entity)
+                if not e:
+                    # cache at this point is now empty
+                    del self._cache[old_pos]
+
+            if e1 is None:
+                e1 = self._cache[stream_pos] = set()
+            e1.add(entity)
+            self._entity_to_key[entity] = stream_pos
+
+        self._evict()
+
     def _evict(self):
         while len(self._cache) > self._max_size:
             k, r = self._cache.popitem(0)
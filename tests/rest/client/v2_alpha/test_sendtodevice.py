@@ -73,6 +73,80 @@ class SendToDeviceTestCase(HomeserverTestCase):
         self.assertEqual(channel.code, 200, channel.result)
         self.assertEqual(channel.json_body.get("to_device", {}).get("events", []), [])
 
+    def test_wildcard_and_unknown_devices(self):
+        """Messages to "*" should go to all of a user's devices, and messages to
+        unknown devices should be dropped"""
+        user1 = self.register_user("u1", "pass")
+        user1_tok = self.login("u1", "pass", "d1")
+
+        user2 = self.register_user("u2", "pass")
+        user2_tok_d2 = self.login("u2", "pass", "d2")
+        user2_tok_d3 = self.login("u2", "pass", "d3")
+
+        user3 = self.register_user("u3", "pass")
+        user3_tok = self.login("u3", "pass", "d4")
+
+        chan = self.make_request(
+            "PUT",
+            "/_matrix/client/r0/sendToDevice/m.test/1234",
+            content={
+                "messages": {
+                    user2: {"*": {"to": "u2"}},
+                    user3: {"d4": {"to": "u3"}, "unknown": {"to": "nobody"}},
+                }
+            },
+            access_token=user1_tok,
+        )
+        self.assertEqual(chan.code, 200, chan.result)
+
+        for access_token, expected_content in (
+            (user2_tok_d2, {"to": "u2"}),
+            (user2_tok_d3, {"to": "u2"}),
+            (user3_tok, {"to": "u3"}),
+        ):
+            channel = self.make_request("GET", "/sync", access_token=access_token)
+            self.assertEqual(channel.code, 200, channel.result)
+            self.assertEqual(
+                channel.json_body["to_device"]["events"],
+                [{"sender": user1, "type": "m.test", "content": expected_content}],
+            )
+
+    def test_awkward_json(self):
+        """Messages with content that the JSON encoder has to handle carefully
+        should still be accepted and delivered"""
+        user1 = self.register_user("u1", "pass")
+        user1_tok = self.login("u1", "pass", "d1")
+
+        user2 = self.register_user("u2", "pass")
+        user2_tok = self.login("u2", "pass", "d2")
+
+        test_msg = {"n": 100000000000000000000000}
+        chan = self.make_request(
+            "PUT",
+            "/_matrix/client/r0/sendToDevice/m.test/1",
+            content={"messages": {user2: {"d2": test_msg}}},
+            access_token=user1_tok,
+        )
+        self.assertEqual(chan.code, 200, chan.result)
+
+        channel = self.make_request("GET", "/sync", access_token=user2_tok)
+        self.assertEqual(channel.code, 200, channel.result)
+        self.assertEqual(
+            channel.json_body["to_device"]["events"],
+            [{"sender": user1, "type": "m.test", "content": test_msg}],
+        )
+
+        # A lone surrogate can't be written into a valid UTF-8 /sync response,
+        # so we only check that it is accepted. That it is stored intact is
+        # checked by the storage tests.
+        chan = self.make_request(
+            "PUT",
+            "/_matrix/client/r0/sendToDevice/m.test/2",
+            content={"messages": {user2: {"d2": {"s": "\ud800"}}}},
+            access_token=user1_tok,
+        )
+        self.assertEqual(chan.code, 200, chan.result)
+
     @override_config({"rc_key_requests": {"per_second": 10, "burst_count": 2}})
     def test_local_room_key_request(self):
         """m.room_key_request has special-casing; test from local user"""
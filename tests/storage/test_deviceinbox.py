@@ -0,0 +1,327 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.mock import patch
+
+from twisted.internet import defer
+
+from tests.unittest import HomeserverTestCase
+
+
+class DeviceInboxStoreTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.get_success(self.store.store_device("@user:test", "device", None))
+
+    def test_concurrent_sends_are_batched(self):
+        """Concurrent calls to `add_messages_to_device_inbox` should be stored
+        in a single transaction, with a stream ID each.
+        """
+        start_token = self.store.get_to_device_stream_token()
+
+        with patch.object(
+            self.store.db_pool,
+            "runInteraction",
+            wraps=self.store.db_pool.runInteraction,
+        ) as run_interaction:
+            d1 = defer.ensureDeferred(
+                self.store.add_messages_to_device_inbox(
+                    {"@user:test": {"device": {"idx": 1}}}, {}
+                )
+            )
+            d2 = defer.ensureDeferred(
+                self.store.add_messages_to_device_inbox(
+                    {"@user:test": {"device": {"idx": 2}}}, {}
+                )
+            )
+            self.pump()
+
+            token1 = self.successResultOf(d1)
+            token2 = self.successResultOf(d2)
+
+        descs = [call[0][0] for call in run_interaction.call_args_list]
+        self.assertEqual(descs.count("add_messages_to_device_inbox"), 1)
+
+        self.assertEqual(token1, start_token + 2)
+        self.assertEqual(token2, start_token + 2)
+
+        messages, _ = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, token2
+            )
+        )
+        self.assertEqual(messages, [{"idx": 1}, {"idx": 2}])
+
+        # Each of the sends should get its own stream ID.
+        messages, _ = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, start_token + 1
+            )
+        )
+        self.assertEqual(messages, [{"idx": 1}])
+
+    def test_get_new_messages_for_device_skips_empty_query(self):
+        """Once we've seen that a device has no new messages, we shouldn't query
+        for them again until the user has had new messages.
+        """
+        self.get_success(self.store.store_device("@user:test", "other", None))
+
+        start_token = self.store.get_to_device_stream_token()
+
+        # Send a message to the user's other device, so that the user has had a
+        # change since the start token.
+        token = self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {"other": {"idx": 1}}}, {}
+            )
+        )
+
+        messages, stream_pos = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, token
+            )
+        )
+        self.assertEqual(messages, [])
+        self.assertEqual(stream_pos, token)
+
+        # Asking again shouldn't hit the database.
+        with patch.object(
+            self.store.db_pool,
+            "runInteraction",
+            wraps=self.store.db_pool.runInteraction,
+        ) as run_interaction:
+            messages, stream_pos = self.get_success(
+                self.store.get_new_messages_for_device(
+                    "@user:test", "device", start_token, token
+                )
+            )
+        self.assertEqual(messages, [])
+        self.assertEqual(stream_pos, token)
+        run_interaction.assert_not_called()
+
+        # But new messages for the device should still be returned.
+        token = self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {"device": {"idx": 2}}}, {}
+            )
+        )
+        messages, stream_pos = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, token
+            )
+        )
+        self.assertEqual(messages, [{"idx": 2}])
+        self.assertEqual(stream_pos, token)
+
+    def test_get_all_new_device_messages(self):
+        """Local and remote messages should both be returned for replication, in
+        stream order, and then ordered by entity within a stream ID.
+        """
+        self.get_success(self.store.store_device("@other:test", "device", None))
+        self.get_success(self.store.store_device("@another:test", "device", None))
+
+        start_token = self.store.get_to_device_stream_token()
+
+        remote_token = self.get_success(
+            self.store.add_messages_to_device_inbox({}, {"remote": {"idx": 1}})
+        )
+        local_token = self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {"device": {"idx": 2}}}, {}
+            )
+        )
+        # A single send to several users and destinations shares a stream ID.
+        multi_token = self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {
+                    "@other:test": {"device": {"idx": 3}},
+                    "@another:test": {"device": {"idx": 3}},
+                },
+                {"other_remote": {"idx": 3}, "another_remote": {"idx": 3}},
+            )
+        )
+
+        updates, upto_token, limited = self.get_success(
+            self.store.get_all_new_device_messages(
+                "master", start_token, multi_token, 10
+            )
+        )
+        self.assertEqual(
+            updates,
+            [
+                (remote_token, ("remote",)),
+                (local_token, ("@user:test",)),
+                (multi_token, ("@another:test",)),
+                (multi_token, ("@other:test",)),
+                (multi_token, ("another_remote",)),
+                (multi_token, ("other_remote",)),
+            ],
+        )
+        self.assertEqual(upto_token, multi_token)
+        self.assertFalse(limited)
+
+    def test_many_devices(self):
+        """Sending more messages than fit in a single INSERT should still store
+        all of them.
+        """
+        for i in range(100):
+            self.get_success(self.store.store_device("@user:test", f"d{i}", None))
+
+        self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {f"d{i}": {"idx": i} for i in range(100)}},
+                {f"remote{i}": {"idx": i} for i in range(100)},
+            )
+        )
+
+        rows = self.get_success(
+            self.store.db_pool.simple_select_list(
+                "device_inbox", {"user_id": "@user:test"}, ("device_id",)
+            )
+        )
+        self.assertCountEqual(
+            [row["device_id"] for row in rows], [f"d{i}" for i in range(100)]
+        )
+
+        rows = self.get_success(
+            self.store.db_pool.simple_select_list(
+                "device_federation_outbox", None, ("destination",)
+            )
+        )
+        self.assertEqual(len(rows), 100)
+
+    def test_duplicate_remote_messages_are_ignored(self):
+        """Receiving the same to-device EDU twice from a remote server should only
+        deliver its messages once.
+        """
+        start_token = self.store.get_to_device_stream_token()
+
+        for idx in (1, 2):
+            token = self.get_success(
+                self.store.add_messages_from_remote_to_device_inbox(
+                    "remote", "message_id", {"@user:test": {"device": {"idx": idx}}}
+                )
+            )
+
+        messages, _ = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, token
+            )
+        )
+        self.assertEqual(messages, [{"idx": 1}])
+
+        rows = self.get_success(
+            self.store.db_pool.simple_select_list(
+                "device_federation_inbox",
+                {"origin": "remote", "message_id": "message_id"},
+                ("received_ts",),
+            )
+        )
+        self.assertEqual(len(rows), 1)
+
+    def test_get_new_messages_for_device_limited(self):
+        """If there are more messages than the limit, the returned stream position
+        should let us pick up where we left off.
+        """
+        start_token = self.store.get_to_device_stream_token()
+
+        tokens = [
+            self.get_success(
+                self.store.add_messages_to_device_inbox(
+                    {"@user:test": {"device": {"idx": idx}}}, {}
+                )
+            )
+            for idx in range(3)
+        ]
+
+        messages, stream_pos = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, tokens[-1], limit=2
+            )
+        )
+        self.assertEqual(messages, [{"idx": 0}, {"idx": 1}])
+        self.assertEqual(stream_pos, tokens[1])
+
+        messages, stream_pos = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", stream_pos, tokens[-1], limit=2
+            )
+        )
+        self.assertEqual(messages, [{"idx": 2}])
+        self.assertEqual(stream_pos, tokens[-1])
+
+    def test_add_no_messages(self):
+        """Adding no messages shouldn't touch the database or advance the stream."""
+        start_token = self.store.get_to_device_stream_token()
+
+        with patch.object(
+            self.store.db_pool,
+            "runInteraction",
+            wraps=self.store.db_pool.runInteraction,
+        ) as run_interaction:
+            token = self.get_success(self.store.add_messages_to_device_inbox({}, {}))
+
+        self.assertEqual(token, start_token)
+        run_interaction.assert_not_called()
+
+    def test_awkward_json_round_trips(self):
+        """Messages that are valid JSON but awkward to (de)serialise, such as big
+        integers and lone surrogates, should be stored and returned unchanged.
+        """
+        big_int = {"n": 100000000000000000000000, "m": -9223372036854775809}
+        surrogate = {"s": "\ud800"}
+
+        start_token = self.store.get_to_device_stream_token()
+
+        self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {"device": big_int}}, {"remote": big_int}
+            )
+        )
+        self.get_success(
+            self.store.add_messages_to_device_inbox(
+                {"@user:test": {"device": surrogate}}, {"remote": surrogate}
+            )
+        )
+        token = self.get_success(
+            self.store.add_messages_from_remote_to_device_inbox(
+                "remote", "message_id", {"@user:test": {"device": big_int}}
+            )
+        )
+
+        messages, _ = self.get_success(
+            self.store.get_new_messages_for_device(
+                "@user:test", "device", start_token, token
+            )
+        )
+        self.assertEqual(messages, [big_int, surrogate, big_int])
+
+        messages, _ = self.get_success(
+            self.store.get_new_device_msgs_for_remote("remote", start_token, token, 10)
+        )
+        self.assertEqual(messages, [big_int, surrogate])
+
+    def test_logs_stored_devices(self):
+        """The debug logging for to-device messages should only list the devices
+        that messages were actually stored for.
+        """
+        with self.assertLogs("synapse.9533_debug", level="DEBUG") as logs:
+            self.get_success(
+                self.store.add_messages_to_device_inbox(
+                    {"@user:test": {"device": {"idx": 1}, "unknown": {"idx": 2}}}, {}
+                )
+            )
+
+        self.assertIn("[('@user:test', 'device')]", "\n".join(logs.output))
@@ -0,0 +1,75 @@
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os.path
+import sqlite3
+import tempfile
+
+from synapse.storage.database import LoggingDatabaseConnection
+from synapse.storage.engines import create_engine
+
+from tests import unittest
+
+
+class Sqlite3EngineTestCase(unittest.TestCase):
+    def _open_connection(self, database_config):
+        """Opens a connection to the configured database, and sets it up the way
+        Synapse's connection pool would.
+        """
+        engine = create_engine(database_config)
+        db_conn = sqlite3.connect(database_config["args"]["database"])
+        engine.on_new_connection(
+            LoggingDatabaseConnection(db_conn, engine, "on_new_connection")
+        )
+        return db_conn
+
+    def _get_pragma(self, db_conn, pragma):
+        return db_conn.execute("PRAGMA %s" % (pragma,)).fetchone()[0]
+
+    def test_synchronous_commit_off(self):
+        """Turning off synchronous_commit should switch the database to WAL mode
+        with synchronous=NORMAL.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_conn = self._open_connection(
+                {
+                    "name": "sqlite3",
+                    "synchronous_commit": False,
+                    "args": {"database": os.path.join(tmp_dir, "homeserver.db")},
+                }
+            )
+
+            self.assertEqual(self._get_pragma(db_conn, "journal_mode"), "wal")
+            # 1 is NORMAL.
+            self.assertEqual(self._get_pragma(db_conn, "synchronous"), 1)
+
+            db_conn.close()
+
+    def test_synchronous_commit_default(self):
+        """By default the journal mode and synchronous setting should be left
+        alone.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_conn = self._open_connection(
+                {
+                    "name": "sqlite3",
+                    "args": {"database": os.path.join(tmp_dir, "homeserver.db")},
+                }
+            )
+
+            self.assertEqual(self._get_pragma(db_conn, "journal_mode"), "delete")
+            # 2 is FULL.
+            self.assertEqual(self._get_pragma(db_conn, "synchronous"), 2)
+
+            db_conn.close()
@@ -86,6 +86,44 @@ class StreamChangeCacheTests(unittest.HomeserverTestCase):
         )
         self.assertIsNone(cache.get_all_entities_changed(1))
 
+    def test_entities_have_changed(self):
+        """
+        StreamChangeCache.entities_have_changed will mark all the given entities
+        as changed at the given position, the same as calling
+        entity_has_changed for each of them.
+        """
+        cache = StreamChangeCache("#test", 1, max_size=2)
+
+        cache.entity_has_changed("user@foo.com", 2)
+        cache.entity_has_changed("bar@baz.net", 5)
+
+        cache.entities_have_changed(["user@foo.com", "bar@baz.net", "new@foo.com"], 4)
+
+        # user@foo.com moves to the new position, bar@baz.net keeps its later
+        # one.
+        self.assertEqual(cache.get_max_pos_of_last_change("user@foo.com"), 4)
+        self.assertEqual(cache.get_max_pos_of_last_change("bar@baz.net"), 5)
+        self.assertEqual(cache.get_max_pos_of_last_change("new@foo.com"), 4)
+
+        self.assertTrue(cache.has_entity_changed("new@foo.com", 3))
+        self.assertFalse(cache.has_entity_changed("new@foo.com", 4))
+
+        # The now empty entry for position 2 should have been removed, rather
+        # than pushing position 4 out of the cache.
+        self.assertEqual(len(cache._cache), 2)
+        entities = cache.get_all_entities_changed(1)
+        assert entities is not None
+        self.assertCountEqual(entities, ["user@foo.com", "new@foo.com", "bar@baz.net"])
+
+        # Changes at or before the earliest known position are ignored.
+        cache.entities_have_changed(["old@foo.com"], 1)
+        self.assertNotIn("old@foo.com", cache._entity_to_key)
+
+        # And the max size is still respected.
+        cache.entities_have_changed(["user@foo.com"], 6)
+        self.assertEqual(len(cache._cache), 2)
+        self.assertIsNone(cache.get_all_entities_changed(1))
+
     def test_get_all_entities_changed(self):
         """
         StreamChangeCache.get_all_entities_changed will return all changed